@@ -1,30 +1,46 @@
-from pyspark import SparkContext, SparkConf
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from pyspark import SparkContext, SparkConf, StorageLevel
 from pyspark.sql import SparkSession
-from pyspark.sql.functions import datediff, to_date, lit, to_timestamp, col, hour
+from pyspark.sql.functions import datediff, to_date, lit, to_timestamp, col, unix_timestamp, create_map, struct, \
+    count, floor, pmod, max as spark_max, sum as spark_sum
+from pyspark.sql.types import StructType, StructField, IntegerType, StringType
 
 
 def join_look_up_with_cities(df, lookup_df):
     """
     Join the taxi dataset with the lookup table to enrich location data.
+    The lookup table is tiny, so it is collected to the driver and applied as a
+    map literal, resolving both pickup and drop-off zones in a single projection.
     :param df: Taxi dataframe
     :param lookup_df: Lookup dataframe
     :return: Joined dataframe
     """
-    joined_df = df.join(
-        lookup_df.withColumnRenamed("LocationID", "PU_LocationID"),
-        df["PULocationID"] == col("PU_LocationID"),
-        "left"
-    ).withColumnRenamed("Zone", "PU_Zone") \
-     .withColumnRenamed("Borough", "PU_Borough") \
-     .drop("PU_LocationID") \
-     .join(
-        lookup_df.withColumnRenamed("LocationID", "DO_LocationID"),
-        df["DOLocationID"] == col("DO_LocationID"),
-        "left"
-    ).withColumnRenamed("Zone", "DO_Zone") \
-     .withColumnRenamed("Borough", "DO_Borough") \
-     .drop("DO_LocationID")
-    
+    # Key the map by bigint, the location IDs in the trip files are int64; the
+    # fact-side cast is a no-op there and only ever widens otherwise
+    zone_map = create_map(*[
+        item
+        for row in lookup_df.collect()
+        if row["LocationID"] is not None
+        for item in (
+            lit(row["LocationID"]).cast("long"),
+            struct(lit(row["Zone"]).cast("string").alias("Zone"),
+                   lit(row["Borough"]).cast("string").alias("Borough"))
+        )
+    ])
+    pu_location = zone_map[col("PULocationID").cast("long")]
+    do_location = zone_map[col("DOLocationID").cast("long")]
+
+    joined_df = df.select(
+        "*",
+        pu_location["Zone"].alias("PU_Zone"),
+        pu_location["Borough"].alias("PU_Borough"),
+        do_location["Zone"].alias("DO_Zone"),
+        do_location["Borough"].alias("DO_Borough")
+    )
+
     return joined_df
 
 
@@ -46,90 +62,181 @@ def get_most_expensive_route(df):
     """
     Find the most expensive route (highest fare amount) for each dataset.
     :param df: Dataframe
+    :return: Row with fare_amount, PU_Zone and DO_Zone of the most expensive route
     """
-    most_expensive_route = df.orderBy(col("fare_amount").desc()).select(
-        "PU_Zone", "DO_Zone", "fare_amount"
-    ).first()
+    # Structs compare field by field, so the max struct is the row with the highest fare
+    most_expensive_route = df.agg(
+        spark_max(struct("fare_amount", "PU_Zone", "DO_Zone")).alias("route")
+    ).first()["route"]
 
-    print(f"Most Expensive Route: {most_expensive_route['PU_Zone']} to {most_expensive_route['DO_Zone']} - ${most_expensive_route['fare_amount']}")
+    return most_expensive_route
 
 def get_top_5_busiest_area(df):
     """
     Find the top 5 busiest pickup zones for each dataset.
     :param df: Dataframe
+    :return: List of rows with PU_Zone and count, busiest first
     """
+    # Only ~265 zones survive the aggregation, rank them in a single task
     top_5_busiest_zones = df.groupBy("PU_Zone") \
-        .count() \
+        .agg(count(lit(1)).alias("count")) \
+        .coalesce(1) \
         .orderBy(col("count").desc()) \
-        .limit(5)
+        .limit(5) \
+        .collect()
     
-    print("Top 5 Busiest Pickup Zones:")
-    top_5_busiest_zones.show()
+    return top_5_busiest_zones
 
 def get_longest_trips(df):
     """
     Find the longest trip (by trip distance) in the dataset.
     :param df: Dataframe
+    :return: Row with trip_distance, PU_Zone and DO_Zone of the longest trip
     """
-    longest_trip = df.orderBy(col("trip_distance").desc()).select(
-        "PU_Zone", "DO_Zone", "trip_distance"
-    ).first()
+    longest_trip = df.agg(
+        spark_max(struct("trip_distance", "PU_Zone", "DO_Zone")).alias("trip")
+    ).first()["trip"]
     
-    print(f"Longest Trip: {longest_trip['PU_Zone']} to {longest_trip['DO_Zone']} - {longest_trip['trip_distance']} miles")
+    return longest_trip
 
-def get_crowded_places_per_hour(df, pickup_col, dropoff_col):
+def run_in_pool(spark, pool, func, *args):
     """
-    Find the most crowded Pickup and Drop-off zones for each hour.
+    Run a query function with its Spark jobs assigned to a FAIR scheduler pool.
+    The pool is a thread-local property, so it has to be set in the thread
+    that submits the jobs.
+    :param spark: SparkSession
+    :param pool: Name of the scheduler pool
+    :param func: Query function to run
+    :return: Result of the query function
+    """
+    spark.sparkContext.setLocalProperty("spark.scheduler.pool", pool)
+    try:
+        return func(*args)
+    finally:
+        spark.sparkContext.setLocalProperty("spark.scheduler.pool", None)
+
+def add_hour_columns(df, pickup_col, dropoff_col):
+    """
+    Add the Pickup and Drop-off hour as PU_Hour and DO_Hour columns.
+    The hour is derived from epoch seconds with integer arithmetic, which
+    matches hour() when the session time zone is UTC. floor and pmod keep
+    pre-epoch outlier timestamps in the 0-23 range as well.
     :param df: Dataframe
     :param pickup_col: Pickup datetime column
     :param dropoff_col: Drop-off datetime column
+    :return: Dataframe with PU_Hour and DO_Hour columns
+    """
+    return df.withColumn("PU_Hour", pmod(floor(unix_timestamp(col(pickup_col)) / 3600).cast("int"), lit(24))) \
+        .withColumn("DO_Hour", pmod(floor(unix_timestamp(col(dropoff_col)) / 3600).cast("int"), lit(24)))
+
+def get_zone_hour_counts(df):
+    """
+    Count Pickups and Drop-offs per hour and zone in a single aggregation.
+    The per-hour queries below are derived from this small result.
+    :param df: Dataframe with PU_Hour and DO_Hour columns (see add_hour_columns)
+    :return: Dataframe with Kind ("Pickup" or "Dropoff"), Hour, Zone and count columns
     """
-    crowded_pickup = df.groupBy(hour(col(pickup_col)).alias("Hour"), "PU_Zone") \
-        .count() \
+    pickups = df.select(
+        lit("Pickup").alias("Kind"), col("PU_Hour").alias("Hour"), col("PU_Zone").alias("Zone")
+    )
+    dropoffs = df.select(
+        lit("Dropoff").alias("Kind"), col("DO_Hour").alias("Hour"), col("DO_Zone").alias("Zone")
+    )
+
+    zone_hour_counts = pickups.unionAll(dropoffs) \
+        .groupBy("Kind", "Hour", "Zone") \
+        .count()
+
+    return zone_hour_counts
+
+def get_crowded_places_per_hour(zone_hour_counts):
+    """
+    Find the most crowded Pickup and Drop-off zones for each hour.
+    :param zone_hour_counts: Dataframe returned by get_zone_hour_counts
+    """
+    crowded_pickup = zone_hour_counts.filter(col("Kind") == "Pickup") \
+        .select("Hour", col("Zone").alias("PU_Zone"), "count") \
+        .coalesce(1) \
         .orderBy(col("Hour"), col("count").desc())
     
     print("Most Crowded Pickup Zones Per Hour:")
     crowded_pickup.show(10, truncate=False)
 
-    crowded_dropoff = df.groupBy(hour(col(dropoff_col)).alias("Hour"), "DO_Zone") \
-        .count() \
+    crowded_dropoff = zone_hour_counts.filter(col("Kind") == "Dropoff") \
+        .select("Hour", col("Zone").alias("DO_Zone"), "count") \
+        .coalesce(1) \
         .orderBy(col("Hour"), col("count").desc())
     
     print("Most Crowded Drop-off Zones Per Hour:")
     crowded_dropoff.show(10, truncate=False)
 
-def get_hourly_pickup_dropoff_counts(df, pickup_col, dropoff_col):
+def get_hourly_pickup_dropoff_counts(zone_hour_counts):
     """
     Calculate hourly Pickup and Drop-off counts and return the dataframes.
-    :param df: Dataframe
-    :param pickup_col: Pickup datetime column
-    :param dropoff_col: Drop-off datetime column
+    :param zone_hour_counts: Dataframe returned by get_zone_hour_counts
     :return: Two dataframes for hourly pickup and drop-off counts
     """
-    hourly_pickup = df.groupBy(hour(col(pickup_col)).alias("Hour")) \
-        .count() \
-        .withColumnRenamed("count", "Pickup_Count") \
+    hourly_pickup = zone_hour_counts.filter(col("Kind") == "Pickup") \
+        .groupBy("Hour") \
+        .agg(spark_sum("count").alias("Pickup_Count")) \
+        .coalesce(1) \
         .orderBy("Hour")
 
-    hourly_dropoff = df.groupBy(hour(col(dropoff_col)).alias("Hour")) \
-        .count() \
-        .withColumnRenamed("count", "Dropoff_Count") \
+    hourly_dropoff = zone_hour_counts.filter(col("Kind") == "Dropoff") \
+        .groupBy("Hour") \
+        .agg(spark_sum("count").alias("Dropoff_Count")) \
+        .coalesce(1) \
         .orderBy("Hour")
     
     return hourly_pickup, hourly_dropoff
 
-def calculate_tip_correlations(df):
+def calculate_tip_correlations(df, fraction=0.05, seed=42):
     """
     Calculate correlations between tip_amount and other numerical columns.
+    All Pearson components are gathered in a single aggregation pass over a
+    random sample, which is plenty for a summary-level correlation estimate.
     :param df: Dataframe
+    :param fraction: Fraction of rows to sample (1.0 uses the full dataframe)
+    :param seed: Random seed for the sample
     """
+    if fraction < 1.0:
+        df = df.sample(withReplacement=False, fraction=fraction, seed=seed)
+
     numeric_columns = ["trip_distance", "fare_amount", "total_amount", "passenger_count"]
-    correlations = {}
-    
+    tip = col("tip_amount").cast("double")
+
+    aggregates = [
+        count(lit(1)).alias("n"),
+        spark_sum(tip).alias("s_tip_amount"),
+        spark_sum(tip * tip).alias("ss_tip_amount")
+    ]
     for col_name in numeric_columns:
-        correlation = df.stat.corr("tip_amount", col_name)
-        correlations[col_name] = correlation
-    
+        value = col(col_name).cast("double")
+        aggregates += [
+            spark_sum(value).alias(f"s_{col_name}"),
+            spark_sum(value * value).alias(f"ss_{col_name}"),
+            spark_sum(tip * value).alias(f"sxy_{col_name}")
+        ]
+    # The other columns are non-null after clean_data, only tips can be missing
+    stats = df.filter(tip.isNotNull()).agg(*aggregates).first()
+
+    n = stats["n"]
+    s_tip, ss_tip = stats["s_tip_amount"], stats["ss_tip_amount"]
+    if n == 0 or s_tip is None:
+        # No rows (e.g. an empty sample) leaves every sum null, report NaN like stat.corr
+        correlations = {col_name: float("nan") for col_name in numeric_columns}
+    else:
+        s = np.array([stats[f"s_{col_name}"] for col_name in numeric_columns], dtype=float)
+        ss = np.array([stats[f"ss_{col_name}"] for col_name in numeric_columns], dtype=float)
+        sxy = np.array([stats[f"sxy_{col_name}"] for col_name in numeric_columns], dtype=float)
+
+        # Pearson correlation for every column at once, NaN where a variance is zero
+        covariance = n * sxy - s_tip * s
+        with np.errstate(divide="ignore", invalid="ignore"):
+            denominator = np.sqrt((n * ss_tip - s_tip ** 2) * (n * ss - s ** 2))
+            values = np.where(denominator > 0, covariance / denominator, np.nan)
+        correlations = dict(zip(numeric_columns, values.tolist()))
+
     print("Correlations with tip_amount:")
     for key, value in correlations.items():
         print(f"{key}: {value}")
@@ -150,12 +257,15 @@ def plot_hourly_counts(hourly_pickup, hourly_dropoff, title, output_path=None):
     :param title: Title for the plot
     :param output_path: Path to save the plot as an image (optional)
     """
-    pickup_pd = hourly_pickup.toPandas()
-    dropoff_pd = hourly_dropoff.toPandas()
+    # At most 24 rows each, plain Python lists are enough for plotting
+    pickup_rows = hourly_pickup.collect()
+    dropoff_rows = hourly_dropoff.collect()
 
     plt.figure(figsize=(12, 6))
-    plt.plot(pickup_pd["Hour"], pickup_pd["Pickup_Count"], label="Pickup", marker="o")
-    plt.plot(dropoff_pd["Hour"], dropoff_pd["Dropoff_Count"], label="Drop-off", marker="o")
+    plt.plot([row["Hour"] for row in pickup_rows], [row["Pickup_Count"] for row in pickup_rows],
+             label="Pickup", marker="o")
+    plt.plot([row["Hour"] for row in dropoff_rows], [row["Dropoff_Count"] for row in dropoff_rows],
+             label="Drop-off", marker="o")
     plt.title(title)
     plt.xlabel("Hour")
     plt.ylabel("Count")
@@ -186,50 +296,99 @@ def plot_correlations(correlations, title, output_path=None):
 
     
 if __name__ == '__main__':
-    spark = SparkSession.builder.appName("TaxiAnalysis").getOrCreate()
+    spark = SparkSession.builder \
+        .appName("TaxiAnalysis") \
+        .config("spark.sql.parquet.filterPushdown", "true") \
+        .config("spark.sql.parquet.aggregatePushdown", "true") \
+        .config("spark.sql.adaptive.enabled", "true") \
+        .config("spark.sql.adaptive.coalescePartitions.enabled", "true") \
+        .config("spark.sql.adaptive.skewJoin.enabled", "true") \
+        .config("spark.sql.adaptive.advisoryPartitionSizeInBytes", "64m") \
+        .config("spark.sql.shuffle.partitions", "400") \
+        .config("spark.serializer", "org.apache.spark.serializer.KryoSerializer") \
+        .config("spark.kryo.registrationRequired", "false") \
+        .config("spark.memory.offHeap.enabled", "true") \
+        .config("spark.memory.offHeap.size", "4g") \
+        .config("spark.sql.inMemoryColumnarStorage.compressed", "true") \
+        .config("spark.sql.inMemoryColumnarStorage.batchSize", "20000") \
+        .config("spark.scheduler.mode", "FAIR") \
+        .config("spark.sql.session.timeZone", "UTC") \
+        .getOrCreate()
 
     # Load data
-    yellow_taxi_df = spark.read.parquet("yellow_tripdata_2021-03.parquet")
-    green_taxi_df = spark.read.parquet("green_tripdata_2021-03.parquet")
-    lookup_df = spark.read.csv("taxi+_zone_lookup.csv", header=True, inferSchema=True)
+    # Only read the columns the analyses use
+    trip_columns = ["PULocationID", "DOLocationID", "fare_amount", "total_amount",
+                    "trip_distance", "passenger_count", "tip_amount"]
+    yellow_taxi_df = spark.read.parquet("yellow_tripdata_2021-03.parquet") \
+        .select(*trip_columns, "tpep_pickup_datetime", "tpep_dropoff_datetime")
+    green_taxi_df = spark.read.parquet("green_tripdata_2021-03.parquet") \
+        .select(*trip_columns, "lpep_pickup_datetime", "lpep_dropoff_datetime")
+    lookup_schema = StructType([
+        StructField("LocationID", IntegerType()),
+        StructField("Borough", StringType()),
+        StructField("Zone", StringType()),
+        StructField("service_zone", StringType())
+    ])
+    lookup_df = spark.read.schema(lookup_schema).csv("taxi+_zone_lookup.csv", header=True).cache()
     
+    # Clean data first so the filters are pushed down into the Parquet scan
+    yellow_taxi_filtered = clean_data(yellow_taxi_df)
+    green_taxi_filtered = clean_data(green_taxi_df)
+
     # Join lookup data
-    yellow_taxi_enriched = join_look_up_with_cities(yellow_taxi_df, lookup_df)
-    green_taxi_enriched = join_look_up_with_cities(green_taxi_df, lookup_df)
-    
-    # Clean data
-    yellow_taxi_cleaned = clean_data(yellow_taxi_enriched)
-    green_taxi_cleaned = clean_data(green_taxi_enriched)
-    
+    yellow_taxi_cleaned = join_look_up_with_cities(yellow_taxi_filtered, lookup_df)
+    green_taxi_cleaned = join_look_up_with_cities(green_taxi_filtered, lookup_df)
+
+    # Project the hours once so the cache holds them for the per-hour queries
+    yellow_taxi_cleaned = add_hour_columns(yellow_taxi_cleaned, "tpep_pickup_datetime", "tpep_dropoff_datetime")
+    green_taxi_cleaned = add_hour_columns(green_taxi_cleaned, "lpep_pickup_datetime", "lpep_dropoff_datetime")
+
+    # Cache the cleaned data off-heap, every analysis below scans it again
+    yellow_taxi_cleaned = yellow_taxi_cleaned.persist(StorageLevel.OFF_HEAP)
+    green_taxi_cleaned = green_taxi_cleaned.persist(StorageLevel.OFF_HEAP)
+    yellow_taxi_cleaned.count()
+    green_taxi_cleaned.count()
+
     # Analysis
-    print("Yellow Taxi Most Expensive Route:")
-    get_most_expensive_route(yellow_taxi_cleaned)
-    
-    print("Green Taxi Most Expensive Route:")
-    get_most_expensive_route(green_taxi_cleaned)
+    # The top-level queries are independent, run them concurrently with each one
+    # in its own FAIR pool so the scheduler shares the cluster between their jobs
+    datasets = [("Yellow", yellow_taxi_cleaned), ("Green", green_taxi_cleaned)]
+    with ThreadPoolExecutor(max_workers=6) as executor:
+        def submit(func, name, df):
+            return executor.submit(run_in_pool, spark, f"{name}_{func.__name__}", func, df)
 
-    print("Yellow Taxi Top 5 Busiest Zones:")
-    get_top_5_busiest_area(yellow_taxi_cleaned)
-    
-    print("Green Taxi Top 5 Busiest Zones:")
-    get_top_5_busiest_area(green_taxi_cleaned)
-    
-    print("Yellow Taxi Longest Trip:")
-    get_longest_trips(yellow_taxi_cleaned)
-    
-    print("Green Taxi Longest Trip:")
-    get_longest_trips(green_taxi_cleaned)
+        expensive_routes = [submit(get_most_expensive_route, name, df) for name, df in datasets]
+        busiest_areas = [submit(get_top_5_busiest_area, name, df) for name, df in datasets]
+        longest_trips = [submit(get_longest_trips, name, df) for name, df in datasets]
+
+    for (name, _), future in zip(datasets, expensive_routes):
+        route = future.result()
+        print(f"{name} Taxi Most Expensive Route:")
+        print(f"Most Expensive Route: {route['PU_Zone']} to {route['DO_Zone']} - ${route['fare_amount']}")
+
+    for (name, _), future in zip(datasets, busiest_areas):
+        print(f"{name} Taxi Top 5 Busiest Zones:")
+        print("Top 5 Busiest Pickup Zones:")
+        for zone in future.result():
+            print(f"{zone['PU_Zone']}: {zone['count']}")
+
+    for (name, _), future in zip(datasets, longest_trips):
+        trip = future.result()
+        print(f"{name} Taxi Longest Trip:")
+        print(f"Longest Trip: {trip['PU_Zone']} to {trip['DO_Zone']} - {trip['trip_distance']} miles")
+
+    # Pickup and Drop-off counts per hour and zone, shared by the per-hour queries
+    yellow_zone_hour_counts = get_zone_hour_counts(yellow_taxi_cleaned).persist()
+    green_zone_hour_counts = get_zone_hour_counts(green_taxi_cleaned).persist()
 
     print("Yellow Taxi Crowded Places Per Hour:")
-    get_crowded_places_per_hour(yellow_taxi_cleaned, "tpep_pickup_datetime", "tpep_dropoff_datetime")
+    get_crowded_places_per_hour(yellow_zone_hour_counts)
     
     print("Green Taxi Crowded Places Per Hour:")
-    get_crowded_places_per_hour(green_taxi_cleaned, "lpep_pickup_datetime", "lpep_dropoff_datetime")
+    get_crowded_places_per_hour(green_zone_hour_counts)
     
     print("Yellow Taxi Hourly Pickup and Drop-off Counts:")
-    yellow_hourly_pickup, yellow_hourly_dropoff = get_hourly_pickup_dropoff_counts(
-        yellow_taxi_cleaned, "tpep_pickup_datetime", "tpep_dropoff_datetime"
-    )
+    yellow_hourly_pickup, yellow_hourly_dropoff = get_hourly_pickup_dropoff_counts(yellow_zone_hour_counts)
     yellow_hourly_pickup.show()
     yellow_hourly_dropoff.show()
     
@@ -241,9 +400,7 @@ if __name__ == '__main__':
     )    
 
     print("Green Taxi Hourly Pickup and Drop-off Counts:")
-    green_hourly_pickup, green_hourly_dropoff = get_hourly_pickup_dropoff_counts(
-        green_taxi_cleaned, "lpep_pickup_datetime", "lpep_dropoff_datetime"
-    )
+    green_hourly_pickup, green_hourly_dropoff = get_hourly_pickup_dropoff_counts(green_zone_hour_counts)
     green_hourly_pickup.show()
     green_hourly_dropoff.show()
     
@@ -271,4 +428,10 @@ if __name__ == '__main__':
         "Green Taxi Tip Correlations",
         "green_taxi_tip_correlations.png"
     )
-    
+
+    yellow_zone_hour_counts.unpersist()
+    green_zone_hour_counts.unpersist()
+    yellow_taxi_cleaned.unpersist()
+    green_taxi_cleaned.unpersist()
+    lookup_df.unpersist()
+